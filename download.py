@@ -6,16 +6,29 @@ The script allows you to recursively download an entire directory structure or e
 """
 
 import argparse
+import atexit
+import contextlib
+import ctypes
+import functools
+import errno
 import os
 import sys
+import secrets
+import shutil
 import random
-import re
+import socket
 import threading
+import itertools
 import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Generator
 
 try:
     import requests
+    import urllib3
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
 except:
     print("ModuleNotFoundError: No module named 'requests' (module 'requests' is not installed)")
     print("You can try install it by command:")
@@ -24,6 +37,11 @@ except:
     print("https://github.com/CERIT-SC/onedata-downloader")
     sys.exit(1)
 
+try:  # optional, faster parsing of big directory listings
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class VERBOSITY:
     DEF = 0
@@ -33,14 +51,23 @@ class VERBOSITY:
 
 V = VERBOSITY
 
-"""Max (lowest) priority for downloading the file 
+"""Priority of new files in the download queue, lower number is higher priority
+"""
+NEW_FILE_PRIORITY: int = 1
+
+"""Retried files get a random priority from 0 to RETRY_PRIORITY_SPREAD,
+so about 1 in 16 of them goes before new files
 """
-MAX_PRIORITY = 3
+RETRY_PRIORITY_SPREAD: int = 15
 
 """Tries of downloading the file after error occurred
 """
 TRIES_NUMBER: int = 7
 
+"""Number of seconds between two tries to download the file
+"""
+TRIES_DELAY: int = 1
+
 """
 Default verbosity level.
 """
@@ -56,6 +83,21 @@ Used Onezone API URI.
 """
 ONEZONE_API: str = "/api/v3/onezone/"
 
+"""
+Used URI of shared data (nodes are identified by their File ID), prefix of the URLs of all the nodes.
+"""
+SHARES_DATA_API: str = f"{ONEZONE_API}shares/data/"
+
+"""
+Attributes of child nodes requested with the directory listing.
+"""
+CHILD_ATTRIBUTES: tuple[str, ...] = ("file_id", "name", "type", "size")
+
+"""
+Max number of children in one page of a directory listing, bigger directories are listed in more pages.
+"""
+LISTING_LIMIT: int = 1000
+
 """
 Chunk size for downloading files as stream in bytes.
 """
@@ -67,14 +109,60 @@ File extension of not yet completely downloaded (part) file.
 PART_FILE_EXTENSION: str = ".oddown_part"
 
 """
-Threads number for parallel downloading.
+Threads number for parallel exploring and downloading.
 """
-THREADS_NUMBER: int = 1
+THREADS_NUMBER: int = 8
 
 """
-Number of seconds between two tries to download the file
+Number of files waiting for download per downloading thread, exploring pauses when the queue is full.
 """
-TRIES_DELAY: int = 1
+QUEUED_FILES_PER_THREAD: int = 4
+
+"""
+Files bigger than this size in bytes are downloaded in parallel segments using HTTP range requests.
+"""
+SEGMENTED_DOWNLOAD_THRESHOLD: int = 64 * 1024 * 1024  # 64 MB
+
+"""
+Number of segments (parallel HTTP range requests) of one big file.
+"""
+SEGMENTS_NUMBER: int = 4
+
+"""
+Timeouts (connect, read) of HTTP requests in seconds.
+"""
+TIMEOUT: tuple[int, int] = (5, 60)
+
+"""
+Headers of file content requests. Metadata responses are compressed (the session asks for gzip by default),
+files are transferred as they are, so ranges and sizes refer to the stored bytes.
+"""
+CONTENT_HEADERS: dict[str, str] = {"Accept-Encoding": "identity"}
+
+"""
+Seconds of idleness of a connection before the first keepalive probe and between the probes.
+"""
+KEEPALIVE_IDLE: int = 60
+KEEPALIVE_INTERVAL: int = 15
+
+"""
+Size of the socket receive buffer in bytes, not set by default. Setting it turns off the receive buffer
+autotuning of Linux, which is better in most cases, and it is capped by net.core.rmem_max.
+"""
+RECEIVE_BUFFER_SIZE: Optional[int] = None
+
+"""
+Shared HTTP session, keeps the connections to Onezone and Oneprovider alive and pooled between requests.
+Its connection pools are set up by setup_session() according to the number of threads.
+"""
+SESSION = requests.Session()
+
+"""
+Max number of HTTP requests sent concurrently, limits the load of Onezone and Oneprovider.
+"""
+MAX_REQUESTS: int = 16
+
+REQUESTS_SEMAPHORE = threading.BoundedSemaphore(MAX_REQUESTS)
 
 ONEZONE: str = DEFAULT_ONEZONE
 
@@ -83,28 +171,20 @@ DIRECTORY: str = "."
 FILE_ID: Optional[str] = None
 
 
-def priority_subtractor():
-    iterator = 0
-    while True:
-        yield -1 if (iterator == 0) else 0
-        iterator = (iterator + 1) % 3
-
-
 class URLs:
     def __init__(self, onezone: str, file_id: str):
-        self._content = onezone + ONEZONE_API + "shares/data/" + file_id + "/content"
-        self._children = onezone + ONEZONE_API + "shares/data/" + file_id + "/children"
-        self._node_attributes = onezone + ONEZONE_API + "shares/data/" + file_id
+        # the other URLs are built once when first needed, each node uses just one of them
+        self._node_attributes = f"{onezone}{SHARES_DATA_API}{file_id}"
 
-    @property
+    @functools.cached_property
     def content(self):
         # https://onedata.org/#/home/api/stable/oneprovider?anchor=operation/download_file_content
-        return self._content
+        return f"{self._node_attributes}/content"
 
-    @property
+    @functools.cached_property
     def children(self):
         # https://onedata.org/#/home/api/stable/oneprovider?anchor=operation/list_children
-        return self._children
+        return f"{self._node_attributes}/children"
 
     @property
     def node_attrs(self):
@@ -113,20 +193,21 @@ class URLs:
 
 
 class DownloadableItem(object):
-    def __init__(self, onezone: str, file_id: str, node_name: str, directory: str):
+    def __init__(self, onezone: str, file_id: str, node_name: str, directory: str, size: int = 0):
         self._onezone: str = onezone
         self._file_id: str = file_id
         self._node_name: str = node_name
         self._directory: str = directory
-        self._priority: int = MAX_PRIORITY  # internal value, lowering
+        self._size: int = size
+        self._priority: int = NEW_FILE_PRIORITY
         self._ttl: int = TRIES_NUMBER
         self._part_filename: str = generate_random_string(size=16) + PART_FILE_EXTENSION
-        self._priority_subtractor: Generator = priority_subtractor()
         self._path = os.path.join(self._directory, self._node_name)  # not to compute it again
         self._part_path = os.path.join(
             self._directory, self._part_filename
         )  # not to compute it again
         self._urls = URLs(self._onezone, self._file_id)
+        self._etag: Optional[str] = None  # of the content the part file is downloaded from
 
     @property
     def onezone(self) -> str:
@@ -144,6 +225,10 @@ class DownloadableItem(object):
     def directory(self) -> str:
         return self._directory
 
+    @property
+    def size(self) -> int:
+        return self._size
+
     @property
     def path(self) -> str:
         return self._path
@@ -151,7 +236,12 @@ class DownloadableItem(object):
     @property
     def priority(self) -> int:
         """Number representing priority, lower number is higher priority"""
-        return MAX_PRIORITY - self._priority
+        return self._priority
+
+    @property
+    def tried(self) -> bool:
+        """Whether downloading of the file was already tried"""
+        return self._ttl != TRIES_NUMBER
 
     @property
     def part_filename(self) -> str:
@@ -165,129 +255,81 @@ class DownloadableItem(object):
     def URL(self) -> URLs:
         return self._urls
 
-    def _decrease_priority(self) -> None:
-        """Lowers the priority by one step"""
-        self._priority = max(0, self._priority + next(self._priority_subtractor))
+    @property
+    def etag(self) -> Optional[str]:
+        return self._etag
+
+    @etag.setter
+    def etag(self, etag: Optional[str]) -> None:
+        self._etag = etag
 
     def try_to_download(self) -> bool:
         if self._ttl == 0:
             return False
 
         self._ttl -= 1
-        self._decrease_priority()
+        # if it fails, it mostly goes after new files, as when the retries had a separate queue
+        self._priority = random.randint(0, RETRY_PRIORITY_SPREAD)
         return True
 
-    def __lt__(self, other) -> bool:
-        """Sorting by priority, lower number is higher priority"""
-        if not isinstance(other, DownloadableItem):
-            raise TypeError(
-                f"Instance of {type(other).__name__} cannot be compared with {type(self).__name__}"
-            )
-        return self.priority < other.priority
-
-
-class QueuePool:
-    def __init__(self, queues: tuple[queue.Queue, ...], weights: tuple[int, ...]):
-        if len(queues) != len(weights):
-            raise AttributeError("Number of queues must be equal to number of their weights")
-
-        self._queues = queues
-        self._weights = weights
-
-        _weights = []
-        for item in [[index] * weight for index, weight in enumerate(weights)]:
-            _weights.extend(item)
-        random.shuffle(_weights)  # dequeue to be more fair
-
-        self._weight_queue = queue.Queue()
-        for weight in _weights:
-            self._weight_queue.put(weight)
-
-        self._queue_to_finish = 0
-        self._mutex = threading.Lock()
-
-    def __len__(self):
-        return len(self._queues)
-
-    def join(self):
-        for key, act_queue in enumerate(self._queues):
-            act_queue.join()
 
-    def _increase_weight(self, index: int, thread_number: int):
-        if index == len(self) - 1:
-            return
-
-        passed_queue_items = 0
-        while self._weight_queue.qsize() != sum(
-            self._weights[self._queue_to_finish + 1 :]
-        ) and passed_queue_items < sum(self._weights):
-            # deadlock possibility if different thread has not yet put number back
-            try:
-                act_ind = self._weight_queue.get(block=False)
-            except queue.Empty:
-                passed_queue_items += 1
-                continue
-            if act_ind != index:
-                self._weight_queue.put(act_ind)
-            passed_queue_items += 1
-
-        if self._queue_to_finish == index:
-            v_print(
-                V.V, f"Thread {thread_number}: increasing queue index {self._queue_to_finish}++"
-            )
-            self._queue_to_finish += 1
-
-    def _try_to_increase_weight(self, index: int, thread_number: int) -> int:
-        v_print(V.VV, f"Thread {thread_number}: trying to acquire mutex")
-        self._mutex.acquire(blocking=True)
-        v_print(V.VV, f"Thread {thread_number}: mutex acquired")
-
-        if not (self._queue_to_finish >= index and self.get_queue(index).qsize() == 0):
-            v_print(V.VV, f"Thread {thread_number}: condition not met, releasing")
-            self._mutex.release()
-            index = self._weight_queue.get()
-            return index
-
-        self._increase_weight(index, thread_number)
+ROOT_DIRECTORY_SIZE = 0
+ALL_DIRECTORIES = 0
+DIRECTORIES_CREATED = 0
+DIRECTORIES_NOT_CREATED_OS_ERROR = 0
 
-        v_print(V.VV, f"Thread {thread_number}: releasing mutex")
-        self._mutex.release()
+ALL_FILES = 0
+# paths are only appended by the threads and read at the end, deque.append() is thread-safe
+EXISTENT_FILES = deque()
+FINISHED_FILES = deque()
+PART_FILES = deque()
+# sizes are summed as the files are processed, not to stat all of them at the end
+EXISTENT_SIZE = 0
+FINISHED_SIZE = 0
 
-        index = self._weight_queue.get()
-        return index
 
-    def fair_index(self, thread_number: int):
-        index = self._weight_queue.get()
+"""
+Files to download ordered by their priority, new files (NEW_FILE_PRIORITY) go before most retried ones.
+Items are tuples (priority, sequence number, file), the sequence keeps the order of equal priorities.
+"""
+FILE_QUEUE = queue.PriorityQueue()
 
-        if self._queue_to_finish >= index and self.get_queue(index).qsize() == 0:
-            self._weight_queue.put(index)
-            index = self._try_to_increase_weight(index, thread_number)
+FILE_SEQUENCE = itertools.count()
 
-        self._weight_queue.put(index)
-        return index
+"""
+Free places for new files in FILE_QUEUE, retried files are put back without waiting for a place.
+"""
+NEW_FILE_SLOTS = threading.BoundedSemaphore(THREADS_NUMBER * QUEUED_FILES_PER_THREAD)
 
-    def get_queue(self, index: int) -> queue.Queue:
-        if index >= len(self._queues) or index < 0:
-            raise IndexError("Queue index out of bounds")
-        return self._queues[index]
+ERROR_QUEUE = deque()
 
+"""
+Set when the program is interrupted, the threads stop exploring and do not start new downloads.
+"""
+SHUTDOWN = threading.Event()
 
-ROOT_DIRECTORY_SIZE = 0
-ALL_DIRECTORIES = 0
-DIRECTORIES_CREATED = 0
-DIRECTORIES_NOT_CREATED_OS_ERROR = 0
+"""
+Lock guarding the counters above, the directory structure is explored by multiple threads.
+"""
+COUNTERS_LOCK = threading.Lock()
 
-ALL_FILES = 0
-EXISTENT_FILES = queue.Queue()
-FINISHED_FILES = queue.Queue()
-PART_FILES = queue.Queue()
+"""
+Messages waiting to be printed by the printer thread.
+"""
+PRINT_QUEUE = queue.Queue()
 
+PRINTER: Optional[threading.Thread] = None
 
-_file_queue = queue.Queue()
-_priority_file_queue = queue.PriorityQueue()
-QP = QueuePool(queues=(_file_queue, _priority_file_queue), weights=(15, 1))
+"""
+Beginning of the line printed in parts by the thread, so the lines of different threads are not mixed.
+"""
+PENDING_LINES = threading.local()
 
-ERROR_QUEUE = queue.Queue()
+"""
+Thread pool exploring the directory structure and futures of the nodes submitted to it.
+"""
+EXPLORER: Optional[ThreadPoolExecutor] = None
+EXPLORING_FUTURES = queue.Queue()
 
 
 def convert_chunk_size(chunk_size: str) -> int:
@@ -328,29 +370,42 @@ def generate_random_string(size: int = 16) -> str:
     if size < 0:
         return ""
 
-    characters = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz1234567890"
-    random_string = "".join(random.choices(characters, k=size))
+    # hexadecimal digits, safe also on case insensitive file systems
+    random_string = secrets.token_hex((size + 1) // 2)[:size]
     return random_string
 
 
+def find_part_files(directory: str) -> Generator[str, None, None]:
+    """
+    Yields paths of files in tree with extension defined by global value PART_FILE_EXTENSION.
+    Directories which cannot be listed are skipped, the same as os.walk() does.
+    """
+    subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif entry.name.endswith(PART_FILE_EXTENSION):
+                    yield entry.path
+    except OSError:
+        return
+    for subdirectory in subdirectories:
+        yield from find_part_files(subdirectory)
+
+
 def remove_part_files(directory_to_search: str) -> bool:
     """
     Removes files in tree with extension defined by global value PART_FILE_EXTENSION
     """
-    pattern = ".*\\" + PART_FILE_EXTENSION + "$"
     try:
-        for root, directories, files in os.walk(directory_to_search):
-            for actual_file in files:
-                if re.match(pattern, actual_file):
-                    file_path = os.path.join(root, actual_file)
-                    try:
-                        os.remove(
-                            file_path
-                        )  # cannot get OSError, because not going through directories
-                    except FileNotFoundError:
-                        v_print(V.DEF, f"cannot remove {file_path}, it does not exist")
-                    else:
-                        v_print(V.DEF, f"Partially downloaded file {file_path} removed")
+        for file_path in find_part_files(directory_to_search):
+            try:
+                os.remove(file_path)  # cannot get OSError, because not going through directories
+            except FileNotFoundError:
+                v_print(V.DEF, f"cannot remove {file_path}, it does not exist")
+            else:
+                v_print(V.DEF, f"Partially downloaded file {file_path} removed")
     except OSError as e:
         v_print(V.DEF, "failed while removing part files, exception occured:", e.__class__.__name__)
         return False
@@ -358,20 +413,184 @@ def remove_part_files(directory_to_search: str) -> bool:
     return True
 
 
+def parse_json(response: requests.Response):
+    """
+    Parse JSON body of the response, using orjson when it is installed.
+    """
+    if orjson is None:
+        return response.json()
+    return orjson.loads(response.content)
+
+
+def parse_error_json(response: requests.Response) -> dict:
+    """
+    Parse JSON body of the error response, empty dictionary is returned when the body is not JSON
+    (e.g. an error page of a proxy).
+    """
+    try:
+        response_json = parse_json(response)
+    except ValueError:  # JSON decode errors of both json and orjson
+        return {}
+    return response_json if isinstance(response_json, dict) else {}
+
+
+def local_file_size(path: str) -> int:
+    """
+    Returns size of the local file, or -1 when it does not exist.
+    """
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return -1
+
+
+def local_file_sizes(directory: str) -> dict[str, int]:
+    """
+    Returns sizes of the files in the local directory by their names, the directory is listed at once.
+    """
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name: entry.stat().st_size for entry in entries if entry.is_file()}
+    except OSError:
+        return {}
+
+
+def safe_print(*args, **kwargs):
+    """
+    Print the message, characters the console cannot encode are escaped (e.g. non-ASCII file names),
+    the message is dropped when the console is closed (e.g. broken pipe).
+    """
+    try:
+        try:
+            print(*args, **kwargs)
+        except UnicodeEncodeError:
+            encoding = sys.stdout.encoding or "ascii"
+            escaped = (
+                str(arg).encode(encoding, "backslashreplace").decode(encoding) for arg in args
+            )
+            print(*escaped, **kwargs)
+    except OSError:
+        pass
+
+
+def printer():
+    """
+    Print queued messages, so the threads don't wait for the console and their output is not mixed.
+    """
+    while True:
+        args, kwargs = PRINT_QUEUE.get()
+        try:
+            kwargs.pop("flush", None)  # flushed once there is nothing more to print
+            safe_print(*args, **kwargs)
+            if PRINT_QUEUE.empty():
+                sys.stdout.flush()
+        except Exception:  # the thread must not die, PRINT_QUEUE.join() would wait forever
+            pass
+        finally:
+            PRINT_QUEUE.task_done()
+
+
+def start_printer():
+    """
+    Start printing messages of verbose_print in background thread, all of them are printed before exit.
+    """
+    global PRINTER
+    PRINTER = threading.Thread(target=printer, daemon=True)
+    PRINTER.start()
+    atexit.register(PRINT_QUEUE.join)
+
+
 def verbose_print(level, *args, **kwargs):
     """
     Print only when VERBOSITY is equal or higher than given level.
+    A line printed in parts (with end other than a new line) is queued at once when it is finished.
     """
     if VERBOSITY >= level:
-        print(*args, **kwargs)
+        if PRINTER is None:
+            print(*args, **kwargs)
+            return
+
+        sep = kwargs.get("sep")
+        end = kwargs.get("end")
+        text = (" " if sep is None else sep).join(map(str, args)) + ("\n" if end is None else end)
+        text = getattr(PENDING_LINES, "text", "") + text
+        if not text.endswith("\n"):  # the rest of the line follows
+            PENDING_LINES.text = text
+            return
+        PENDING_LINES.text = ""
+        PRINT_QUEUE.put(((text,), {"end": ""}))
 
 
 v_print = verbose_print
 
 
+class SocketOptionsAdapter(HTTPAdapter):
+    """
+    HTTP adapter setting options of the sockets of its connections.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = [
+            (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),  # idle pooled connections are kept open
+        ]
+        # the first probe is sent after 2 hours by default, too late for NAT and firewall timeouts
+        if hasattr(socket, "TCP_KEEPIDLE") and hasattr(socket, "TCP_KEEPINTVL"):
+            kwargs["socket_options"] += [
+                (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE),
+                (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL),
+            ]
+        if RECEIVE_BUFFER_SIZE is not None:
+            kwargs["socket_options"].append(
+                (socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+            )
+        super().init_poolmanager(*args, **kwargs)
+
+
+def setup_session(pool_size: int):
+    """
+    Mount adapters with connection pools of given size and with retries of failed requests to the session.
+    """
+    adapter = SocketOptionsAdapter(
+        pool_connections=16,
+        pool_maxsize=pool_size,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+            raise_on_status=False,
+        ),
+    )
+    SESSION.mount("https://", adapter)
+    SESSION.mount("http://", adapter)
+
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    """
+    Send GET request through the shared session, at most MAX_REQUESTS requests are sent at once.
+    Responses with status code 429 are retried by the session adapter, respecting Retry-After header.
+    """
+    with REQUESTS_SEMAPHORE:
+        return SESSION.get(url, timeout=TIMEOUT, **kwargs)
+
+
+@contextlib.contextmanager
+def http_stream(url: str, **kwargs) -> Generator[requests.Response, None, None]:
+    """
+    Send GET request for streamed content like http_get(), the response is closed on exit.
+    Its place among the MAX_REQUESTS requests is freed when the headers arrive, so the long transfers
+    of the bodies do not hold back the requests listing the directories.
+    """
+    with REQUESTS_SEMAPHORE:
+        response = SESSION.get(url, timeout=TIMEOUT, stream=True, **kwargs)
+    with response:
+        yield response
+
+
 def error_printer(response: requests.Response, thread_number: int, file: DownloadableItem):
     v_print(V.DEF, "failed", end="")
-    response_json = response.json()
+    response_json = parse_error_json(response)
 
     v_print(V.V, f"Thread {thread_number}:", end=" ")
     if (
@@ -397,30 +616,195 @@ def error_printer(response: requests.Response, thread_number: int, file: Downloa
 
 
 def chunkwise_downloader(
-    request: requests.Response, file: DownloadableItem, thread_number: int
+    request: requests.Response, file: DownloadableItem, thread_number: int, append: bool = True
 ) -> int:
+    # reading the raw stream directly, without creating chunks in iter_content
+    request.raw.decode_content = True
     try:
         with open(
-            file.part_path, "ab"
+            file.part_path, "ab" if append else "wb"
         ) as f:  # if file was already opened and written into, it will continue
-            for chunk in request.iter_content(chunk_size=CHUNK_SIZE, decode_unicode=True):
-                # for chunk in request.iter_content():
-                f.write(chunk)
-                # flushing automatically as OS says
+            shutil.copyfileobj(request.raw, f, length=CHUNK_SIZE)
+            # flushing automatically as OS says
         # the file is closed now
-    except EnvironmentError as e:
+    except (EnvironmentError, urllib3.exceptions.HTTPError) as e:
+        v_print(V.V, f"Thread {thread_number}:", end=" ")
+        v_print(V.DEF, f"Failed {file.path}, exception occured:", e.__class__.__name__)
+        v_print(V.V, str(e))
+        return 1
+
+    return 0
+
+
+def segment_downloader(file: DownloadableItem, start: int, end: int, thread_number: int) -> int:
+    """
+    Download bytes from start to end (inclusive) of the file to the same position in its part file.
+    Returns 0 on success, -1 when the server does not support range requests, 1 otherwise.
+    """
+    headers = {**CONTENT_HEADERS, "Range": f"bytes={start}-{end}"}
+    if file.etag is not None:  # the whole content is sent instead when the file has changed
+        headers["If-Range"] = file.etag
+    try:
+        with http_stream(file.URL.content, headers=headers, allow_redirects=True) as request:
+            if request.status_code != 206:
+                return -1 if request.status_code == 200 else 1
+
+            request.raw.decode_content = True
+            with open(file.part_path, "r+b") as f:
+                f.seek(start)
+                # segments run in a thread pool, which is waited for at exit, so they stop on interrupt
+                while not SHUTDOWN.is_set():
+                    chunk = request.raw.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                written = f.tell() - start
+    except (EnvironmentError, urllib3.exceptions.HTTPError) as e:  # requests exceptions included
         v_print(V.V, f"Thread {thread_number}:", end=" ")
         v_print(V.DEF, f"Failed {file.path}, exception occured:", e.__class__.__name__)
         v_print(V.V, str(e))
         return 1
 
+    if written != end - start + 1:
+        v_print(V.V, f"Thread {thread_number}: segment {start}-{end} of {file.path} is incomplete")
+        return 1
+
     return 0
 
 
+def supports_ranges(file: DownloadableItem) -> bool:
+    """
+    Check with a request for the first byte of the file that the server answers range requests.
+    """
+    try:
+        with http_stream(
+            file.URL.content,
+            headers={**CONTENT_HEADERS, "Range": "bytes=0-0"},
+            allow_redirects=True,
+        ) as request:
+            file.etag = request.headers.get("ETag")
+            return request.status_code == 206
+    except requests.RequestException:
+        return False
+
+
+def load_fallocate():
+    """
+    Returns fallocate() of the C library (Linux only), None when it is not available.
+    It fails with EOPNOTSUPP on file systems not supporting it (e.g. NFS v3, FUSE), unlike
+    os.posix_fallocate(), which glibc emulates there by writing into every block of the file.
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = getattr(libc, "fallocate64", None) or libc.fallocate  # 64-bit offsets
+    except (OSError, TypeError, AttributeError):  # not Linux
+        return None
+    fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+FALLOCATE = load_fallocate()
+
+
+def preallocate(f, size: int):
+    """
+    Reserve disk space for the whole file at once, so the segments are not fragmented and a full disk
+    is found out before downloading. Sparse file of the size is created where it is not supported.
+    """
+    if FALLOCATE is not None:
+        if FALLOCATE(f.fileno(), 0, 0, size) == 0:
+            return
+        error = ctypes.get_errno()
+        if error not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENODEV, errno.ENOSYS):
+            raise OSError(error, os.strerror(error), f.name)
+    f.truncate(size)
+
+
+def segmented_downloader(file: DownloadableItem, thread_number: int) -> int:
+    """
+    Download the file in SEGMENTS_NUMBER parallel HTTP range requests.
+    Returns 0 on success, -1 when the server does not support range requests, 1 otherwise.
+    """
+    if not supports_ranges(file):
+        return -1
+
+    v_print(V.V, f"Thread {thread_number}: downloading {file.path} in {SEGMENTS_NUMBER} segments")
+    try:
+        with open(file.part_path, "wb") as f:
+            preallocate(f, file.size)
+    except OSError as e:
+        v_print(V.V, f"Thread {thread_number}:", end=" ")
+        v_print(V.DEF, f"Failed {file.path}, exception occured:", e.__class__.__name__)
+        v_print(V.V, str(e))
+        return 1
+
+    segment_size = -(-file.size // SEGMENTS_NUMBER)  # ceiling division
+    starts = range(0, file.size, segment_size)
+    ends = [min(start + segment_size, file.size) - 1 for start in starts]
+    with ThreadPoolExecutor(max_workers=SEGMENTS_NUMBER) as executor:
+        results = list(
+            executor.map(
+                segment_downloader,
+                [file] * len(starts),
+                starts,
+                ends,
+                [thread_number] * len(starts),
+            )
+        )
+
+    if all(result == 0 for result in results):
+        return 0
+
+    # the part file has gaps, the next try has to start from the beginning
+    try:
+        os.remove(file.part_path)
+    except OSError:
+        pass
+
+    return -1 if -1 in results else 1
+
+
+def record_existent_file(path: str, size: int):
+    """
+    Count the file which exists and is not downloaded into the statistics.
+    """
+    global EXISTENT_SIZE
+    EXISTENT_FILES.append(path)
+    with COUNTERS_LOCK:
+        EXISTENT_SIZE += size
+
+
+def record_finished_file(path: str, size: int):
+    """
+    Count the downloaded file into the statistics.
+    """
+    global FINISHED_SIZE
+    FINISHED_FILES.append(path)
+    with COUNTERS_LOCK:
+        FINISHED_SIZE += size
+
+
+def content_size(response: requests.Response, default: int) -> int:
+    """
+    Returns size of the whole content from Content-Range (range and 416 responses)
+    or Content-Length header of the response, default when the size is not given.
+    """
+    # bytes 10-19/100, bytes */100
+    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+    if total.isdigit():
+        return int(total)
+    length = response.headers.get("Content-Length", "")
+    encoded = response.headers.get("Content-Encoding", "identity") != "identity"  # compressed size
+    if response.status_code == 200 and length.isdigit() and not encoded:
+        return int(length)
+    return default
+
+
 def renamer(file: DownloadableItem, thread_number: int):
     try:
-        os.rename(file.part_path, file.path)
-        FINISHED_FILES.put(file.path)
+        os.replace(file.part_path, file.path)  # overwrites an outdated file also on Windows
+        record_finished_file(file.path, file.size)
 
         v_print(V.VV, f"Thread {thread_number}: {file.part_filename} renamed to {file.path}")
         v_print(V.V, f"Thread {thread_number}:", end=" ")
@@ -437,54 +821,95 @@ def download_file(file: DownloadableItem, thread_number: int):
     """
     Download file with given file_id to given directory.
     """
-    v_print(
-        V.VV, f"download_file({file.onezone}, {file.file_id}, {file.node_name}, {file.directory})"
-    )
-    # don't download the file when it exists
+    if VERBOSITY >= V.VV:  # called for every file, the message is not formatted in vain
+        v_print(
+            V.VV,
+            f"download_file({file.onezone}, {file.file_id}, {file.node_name}, {file.directory})",
+        )
+    # existing files are not queued at all, process_node() checks them
 
     v_print(V.V, f"Thread {thread_number}:", end=" ")
     v_print(V.V, "Downloading file", file.path, end=" ")
     v_print(V.VV, " (temporary filename " + file.part_filename + ") ", end="")
     v_print(V.V, "started", flush=True)
 
-    if os.path.exists(file.path):
-        EXISTENT_FILES.put(file.path)
-        v_print(V.V, f"Thread {thread_number}:", end=" ")
-        v_print(V.DEF, "File", file.path, "exists, skipped")
-        return 0
-
-    headers = {}
+    headers = dict(CONTENT_HEADERS)
     already_downloaded = 0
-    if os.path.exists(file.part_path):  # incorrectly downloaded
+    part_file_exists = True
+    try:  # one stat instead of testing existence and getting size separately
+        already_downloaded = os.stat(file.part_path).st_size
+    except FileNotFoundError:
+        part_file_exists = False
+    else:  # incorrectly downloaded
         v_print(V.VV, f"Thread {thread_number}:", end=" ")
         v_print(V.V, f"part file exists ({file.part_path})", end=", ")
-        already_downloaded = os.path.getsize(file.part_path)
         v_print(V.V, f"already downloaded {already_downloaded} bytes")
         headers["Range"] = f"bytes={already_downloaded}-"
+        if file.etag is not None:  # the whole content is sent instead when the file has changed
+            headers["If-Range"] = file.etag
+
+    if file.size > SEGMENTED_DOWNLOAD_THRESHOLD and not part_file_exists:
+        result = segmented_downloader(file, thread_number)
+        if result > 0:
+            return 3
+        if result == 0:
+            if renamer(file, thread_number) != 0:
+                return 4
+            v_print(V.DEF, f"Downloading file {file.path} was successful")
+            return 0
+        v_print(V.V, f"Thread {thread_number}: range requests not supported, downloading as stream")
 
-    with requests.get(
-        file.URL.content, headers=headers, allow_redirects=True, stream=True
-    ) as request:
-        if request.status_code == 416:
-            v_print(V.VV, f"Thread {thread_number}:", end=" ")
-            v_print(V.V, "got status code 416 while downloading, trying to get the original size")
-            with requests.get(file.URL.content, allow_redirects=True, stream=True) as request_size:
-                original_size = request_size.headers.get("content-length")
+    try:
+        with http_stream(file.URL.content, headers=headers, allow_redirects=True) as request:
+            if request.status_code == 416:
+                v_print(V.VV, f"Thread {thread_number}:", end=" ")
+                v_print(V.V, "got status code 416 while downloading, checking the original size")
+                # the current size is in "Content-Range: bytes */<size>", otherwise the listed one is used
+                original_size = expected_size = content_size(request, file.size)
                 if already_downloaded != original_size:
                     v_print(
                         V.V,
                         f"the original size does not match, already downloaded: {already_downloaded}, "
                         f"file size: {original_size}",
                     )
+                    try:  # the next try starts from the beginning
+                        os.remove(file.part_path)
+                    except OSError:
+                        pass
                     return 5
                 v_print(V.V, f"the original size does matches, the size is: {already_downloaded}")
-        else:
-            if not request.ok:
-                error_printer(request, thread_number, file)
-                return 2
+            else:
+                if not request.ok:
+                    error_printer(request, thread_number, file)
+                    return 2
+
+                file.etag = request.headers.get("ETag")
+                expected_size = content_size(request, file.size)
+                # full content instead of the requested range, the file changed or ranges are not supported
+                append = request.status_code == 206
+                if part_file_exists and not append:
+                    v_print(
+                        V.V, f"Thread {thread_number}: got whole file, downloading from the start"
+                    )
+                if chunkwise_downloader(request, file, thread_number, append) != 0:
+                    return 3
+    except requests.RequestException as e:
+        v_print(V.V, f"Thread {thread_number}:", end=" ")
+        v_print(V.DEF, f"Failed {file.path}, exception occured:", e.__class__.__name__)
+        v_print(V.V, str(e))
+        return 2
 
-            if chunkwise_downloader(request, file, thread_number) != 0:
-                return 3
+    # the stream can end early without an error (urllib3 older than 2 does not check Content-Length)
+    downloaded = local_file_size(file.part_path)
+    if downloaded != expected_size:
+        v_print(V.V, f"Thread {thread_number}:", end=" ")
+        v_print(V.DEF, f"Failed {file.path}, downloaded {downloaded} of {expected_size} bytes")
+        if downloaded > expected_size:  # the next try starts from the beginning
+            try:
+                os.remove(file.part_path)
+            except OSError:
+                pass
+        return 3
 
     if renamer(file, thread_number) != 0:
         return 4
@@ -498,98 +923,194 @@ def process_directory(onezone, file_id, file_name, directory):
     """
     Process directory and recursively its content.
     """
-    v_print(V.VV, f"process_directory({onezone}, {file_id}, {file_name}, {directory})")
+    if VERBOSITY >= V.VV:
+        v_print(V.VV, f"process_directory({onezone}, {file_id}, {file_name}, {directory})")
     global ALL_DIRECTORIES
     global DIRECTORIES_CREATED
     global DIRECTORIES_NOT_CREATED_OS_ERROR
+    directory_path = os.path.join(directory, file_name)  # shared by all children
+    local_sizes = {}  # files already present in the directory
     # don't create the the directory when it exists
-    v_print(V.DEF, "Processing directory", directory + os.sep + file_name, flush=True)
+    v_print(V.DEF, "Processing directory", directory_path, flush=True)
     try:
-        os.mkdir(directory + os.sep + file_name, mode=0o777)
-        DIRECTORIES_CREATED += 1
+        os.mkdir(directory_path, mode=0o777)
+        with COUNTERS_LOCK:
+            DIRECTORIES_CREATED += 1
         v_print(V.V, "directory created")
     except FileExistsError:  # directory already existent
         v_print(V.DEF, "directory exists, not created")
+        local_sizes = local_file_sizes(directory_path)
     except FileNotFoundError as e:  # parent directory non existent
-        DIRECTORIES_NOT_CREATED_OS_ERROR += 1
+        with COUNTERS_LOCK:
+            DIRECTORIES_NOT_CREATED_OS_ERROR += 1
         v_print(V.DEF, "failed, exception occured:", e.__class__.__name__)
         v_print(V.V, str(e))
         return 2
 
     # get content of new directory
 
-    response = requests.get(URLs(onezone, file_id).children)
-    if not response.ok:
-        v_print(V.DEF, "Error: failed to process directory", file_name)
-        v_print(V.V, "processed directory", file_name, " with File ID =", file_id)
-        v_print(V.V, response.json())
-        return 2
-
-    response_json = response.json()
-    result = 0
-    # process child nodes
-    for child in response_json["children"]:
-        # difference between Onezone version 20 and 21 in name of the key containing the file_id attribute
-        if "file_id" in child:
-            child_file_id = child["file_id"]
-        else:
-            child_file_id = child["id"]
-        result = process_node(onezone, child_file_id, directory + os.sep + file_name) or result
-
-    return result
-
+    children_url = URLs(onezone, file_id).children
+    # ask for the attributes needed by process_node, so it does not have to request them per child
+    params = {"attribute": CHILD_ATTRIBUTES, "limit": LISTING_LIMIT}
+    while True:
+        response = http_get(children_url, params=params)
+        if response.status_code == 400 and "attribute" in params:
+            del params["attribute"]  # older Onezone not supporting the attribute parameter
+            continue
+        if not response.ok:
+            v_print(V.DEF, "Error: failed to process directory", file_name)
+            v_print(V.V, "processed directory", file_name, " with File ID =", file_id)
+            if VERBOSITY >= V.V:  # the body is read and parsed only to be printed
+                v_print(V.V, parse_error_json(response))
+            return 2
 
-def process_node(onezone: str, file_id: str, directory: str):
+        response_json = parse_json(response)
+        children = response_json["children"]
+        # biggest first, so the longest downloads and subtrees are started early
+        children.sort(key=lambda child: child.get("size", 0), reverse=True)
+        # process child nodes in parallel, results are collected by explore()
+        for child in children:
+            # difference between Onezone version 20 and 21 in name of the key containing the file_id attribute
+            if "file_id" in child:
+                child_file_id = child["file_id"]
+            else:
+                child_file_id = child["id"]
+            node_attrs = child if all(key in child for key in ("type", "name", "size")) else None
+            submit_node(onezone, child_file_id, directory_path, node_attrs, local_sizes)
+
+        # the next page is requested with the token of the previous one
+        next_page_token = response_json.get("nextPageToken")
+        if response_json.get("isLast", True) or not next_page_token or SHUTDOWN.is_set():
+            return 0
+        params["token"] = next_page_token
+
+
+def process_node(
+    onezone: str,
+    file_id: str,
+    directory: str,
+    node_attrs: Optional[dict] = None,
+    local_sizes: Optional[dict[str, int]] = None,
+):
     """
     Process given node (directory or file).
+    Node's attributes are requested from Onezone when they are not given (e.g. from directory listing).
+    Sizes of local files in the directory can be given to not test the file existence one by one.
     """
-    v_print(V.VV, "process_node(%s, %s, %s)" % (onezone, file_id, directory))
+    if SHUTDOWN.is_set():  # the program is interrupted, the node stays unexplored
+        return 0
+    if VERBOSITY >= V.VV:  # called for every node, the message is not formatted in vain
+        v_print(V.VV, "process_node(%s, %s, %s)" % (onezone, file_id, directory))
     global ROOT_DIRECTORY_SIZE
     global ALL_FILES
     global ALL_DIRECTORIES
     # get basic node's attributes
+    if node_attrs is None:
+        response = http_get(URLs(onezone, file_id).node_attrs)
+        if not response.ok:
+            v_print(
+                V.DEF,
+                "Error: failed to retrieve information about the node. The requested node may not exist.",
+            )
+            v_print(V.V, "requested node File ID =", file_id)
+            if VERBOSITY >= V.V:
+                v_print(V.V, parse_error_json(response))
+            return 1
+        node_attrs = parse_json(response)
+
+    node_type = node_attrs["type"].upper()
+    node_name = node_attrs["name"]
+    node_size = node_attrs["size"]
+
+    # the root node is the biggest one, the lock is taken only before it is known
+    if node_size > ROOT_DIRECTORY_SIZE:
+        with COUNTERS_LOCK:
+            if node_size > ROOT_DIRECTORY_SIZE:
+                ROOT_DIRECTORY_SIZE = node_size
 
-    response = requests.get(URLs(onezone, file_id).node_attrs)
-    if response.ok:
-        response_json = response.json()
-        node_type = response_json["type"].upper()
-        node_name = response_json["name"]
-        node_size = response_json["size"]
-
-        if node_size > ROOT_DIRECTORY_SIZE:
-            ROOT_DIRECTORY_SIZE = node_size
-
-        result = 0
-        # check if node is directory or folder
-        if node_type == "REG" or node_type == "SYMLNK":
+    result = 0
+    # check if node is directory or folder
+    if node_type == "REG" or node_type == "SYMLNK":
+        with COUNTERS_LOCK:
             ALL_FILES += 1
-            node_path = os.path.join(directory, node_name)
-            if os.path.exists(node_path):
-                EXISTENT_FILES.put(node_path)
-                v_print(V.DEF, f"File {node_path} exists, it will not be downloaded")
-                return 0
-
-            v_print(V.V, "Adding file to queue", node_path)
-            file_queue = QP.get_queue(0)
-            file_queue.put(DownloadableItem(onezone, file_id, node_name, directory))
-        elif node_type == "DIR":
-            ALL_DIRECTORIES += 1
-            result = process_directory(onezone, file_id, node_name, directory) or result
+        node_path = os.path.join(directory, node_name)
+        # existing file of a different size is an incomplete or changed one
+        if local_sizes is None:
+            local_size = local_file_size(node_path)
         else:
-            v_print(V.DEF, "Error: unknown node type")
-            v_print(V.V, "returned node type", node_type, " of node with File ID =", file_id)
-            v_print(V.V, response.json())
-            return 2
+            local_size = local_sizes.get(node_name, -1)
+        if local_size == node_size:
+            record_existent_file(node_path, node_size)
+            v_print(V.DEF, f"File {node_path} exists, it will not be downloaded")
+            return 0
+        if local_size >= 0:
+            v_print(
+                V.DEF, f"File {node_path} exists with a different size, it will be downloaded again"
+            )
 
-        return result
+        v_print(V.V, "Adding file to queue", node_path)
+        # waits while the downloading threads catch up, but not after the program is interrupted
+        while not NEW_FILE_SLOTS.acquire(timeout=1):
+            if SHUTDOWN.is_set():
+                return 0
+        queue_file(DownloadableItem(onezone, file_id, node_name, directory, node_size))
+    elif node_type == "DIR":
+        with COUNTERS_LOCK:
+            ALL_DIRECTORIES += 1
+        result = process_directory(onezone, file_id, node_name, directory) or result
     else:
-        v_print(
-            V.DEF,
-            "Error: failed to retrieve information about the node. The requested node may not exist.",
-        )
-        v_print(V.V, "requested node File ID =", file_id)
-        v_print(V.V, response.json())
-        return 1
+        v_print(V.DEF, "Error: unknown node type")
+        v_print(V.V, "returned node type", node_type, " of node with File ID =", file_id)
+        v_print(V.V, node_attrs)
+        return 2
+
+    return result
+
+
+def submit_node(
+    onezone: str,
+    file_id: str,
+    directory: str,
+    node_attrs: Optional[dict] = None,
+    local_sizes: Optional[dict[str, int]] = None,
+):
+    """
+    Schedule processing of given node in the exploring thread pool.
+    """
+    EXPLORING_FUTURES.put(
+        EXPLORER.submit(process_node, onezone, file_id, directory, node_attrs, local_sizes)
+    )
+
+
+def explore(onezone: str, file_id: str, directory: str) -> int:
+    """
+    Process given node and recursively its content with THREADS_NUMBER threads,
+    wait until the whole directory structure is explored.
+    """
+    global EXPLORER
+    EXPLORER = ThreadPoolExecutor(max_workers=THREADS_NUMBER, thread_name_prefix="explorer")
+    result = 0
+    try:
+        submit_node(onezone, file_id, directory)
+        # children are submitted before their parent finishes, so the queue is empty only at the end
+        while not EXPLORING_FUTURES.empty():
+            try:
+                result = EXPLORING_FUTURES.get().result() or result
+            except (requests.RequestException, ValueError) as e:
+                # the subtree of the node stays unexplored, ValueError is raised by orjson for a body
+                # which is not JSON (requests raises its JSONDecodeError, which is both of them)
+                v_print(
+                    V.DEF, "Error: failure while communicating with Onedata:", e.__class__.__name__
+                )
+                v_print(V.V, str(e))
+                result = 1
+    except KeyboardInterrupt:
+        SHUTDOWN.set()  # the running explorers finish their nodes and stop queueing files
+        raise
+    finally:
+        EXPLORER.shutdown(wait=False, cancel_futures=True)
+
+    return result
 
 
 def clean_onezone(onezone):
@@ -597,15 +1118,17 @@ def clean_onezone(onezone):
     Clean and test of given Onezone service.
     """
     # add protocol name if not specified
-    if not onezone.startswith("https://") and not onezone.startswith("http://"):
+    if not onezone.startswith(("https://", "http://")):
         onezone = "http://" + onezone
+    # URLs are built by appending ONEZONE_API, which starts with a slash
+    onezone = onezone.rstrip("/")
 
     v_print(V.V, "Use Onezone:", onezone)
 
     # test if such Onezone exists
-    url = onezone + ONEZONE_API + "configuration"
+    url = f"{onezone}{ONEZONE_API}configuration"
     try:
-        response = requests.get(url)
+        response = http_get(url)
     except Exception as e:
         v_print(V.DEF, "Error: failure while trying to communicate with Onezone:", onezone)
         v_print(V.V, str(e))
@@ -616,7 +1139,7 @@ def clean_onezone(onezone):
         sys.exit(2)
 
     try:
-        response_json = response.json()
+        response_json = parse_json(response)
         v_print(V.VV, "Onezone configuration:")
         v_print(V.VV, response_json)
     except Exception as e:
@@ -646,69 +1169,71 @@ def clean_directory(directory):
     return directory
 
 
+def queue_file(file: DownloadableItem):
+    """
+    Put the file into FILE_QUEUE according to its priority.
+    """
+    FILE_QUEUE.put((file.priority, next(FILE_SEQUENCE), file))
+
+
 def thread_worker(thread_number: int):
     while True:
-        queue_index = QP.fair_index(thread_number)
-        actual_queue = QP.get_queue(queue_index)
-        try:
+        v_print(V.V, f"Thread {thread_number}: acquiring download or blocked state")
+        _, _, downloadable_item = FILE_QUEUE.get()
+        v_print(V.V, f"Thread {thread_number}: acquired download")
+
+        if not downloadable_item.tried:
+            NEW_FILE_SLOTS.release()
+            PART_FILES.append(downloadable_item.part_path)
+
+        if VERBOSITY >= V.VV:
             v_print(
-                V.V,
-                f"Thread {thread_number}: acquiring download or blocked state in queue {queue_index}",
+                V.VV,
+                f"Thread: {thread_number}, file priority: {downloadable_item.priority}, ttl: {downloadable_item._ttl}",
             )
-            downloadable_item: DownloadableItem = actual_queue.get(block=True)
-            v_print(V.V, f"Thread {thread_number}: acquired download in {queue_index}")
-        except queue.Empty:  # incorrect queue
+        if SHUTDOWN.is_set():  # the program is interrupted, the file is left for the next run
+            FILE_QUEUE.task_done()
             continue
 
-        if queue_index == 0:
-            PART_FILES.put(downloadable_item.part_path)
-
-        v_print(
-            V.VV,
-            f"Thread: {thread_number}, actual queue index: {queue_index}, file priority: {downloadable_item.priority}, ttl: {downloadable_item._ttl}",
-        )
         if downloadable_item.try_to_download():
             result = download_file(downloadable_item, thread_number)
 
             if result != 0:
-                QP.get_queue(1).put(downloadable_item)
+                SHUTDOWN.wait(TRIES_DELAY)  # not to use up all the tries at once
+                queue_file(downloadable_item)  # before task_done, so joining the queue waits for it
         else:
-            ERROR_QUEUE.put(f"The file {downloadable_item.path} could not be downloaded")
+            ERROR_QUEUE.append(f"The file {downloadable_item.path} could not be downloaded")
 
-        actual_queue.task_done()
-
-    return result
+        FILE_QUEUE.task_done()
 
 
 def print_download_statistics(directory_to_search: str, finished: bool = True):
-    errors = ERROR_QUEUE.qsize()
+    PRINT_QUEUE.join()  # print the remaining messages first
+
+    # copies, the threads may still append to the deques when the program did not finish
+    error_messages = list(ERROR_QUEUE)
+    part_paths = list(PART_FILES)
 
-    existent_files = EXISTENT_FILES.qsize()
-    finished_files = FINISHED_FILES.qsize()
+    errors = len(error_messages)
+
+    existent_files = len(EXISTENT_FILES)
+    finished_files = len(FINISHED_FILES)
 
     part_size = 0
-    while not PART_FILES.empty():
-        file_path = PART_FILES.get()
+    for file_path in part_paths:
         if os.path.exists(file_path):
             part_size += os.path.getsize(file_path)
 
-    finished_size = 0
-    while not FINISHED_FILES.empty():
-        file_path = FINISHED_FILES.get()
-        finished_size += os.path.getsize(file_path)
-
-    existent_size = 0
-    while not EXISTENT_FILES.empty():
-        file_path = EXISTENT_FILES.get()
-        existent_size += os.path.getsize(file_path)
+    finished_size = FINISHED_SIZE
+    existent_size = EXISTENT_SIZE
 
     downloaded_size = finished_size + part_size
 
     print()
     if errors != 0:
         print("Errors during execution:")
-        while not ERROR_QUEUE.empty():
-            print(ERROR_QUEUE.get())
+        for error in error_messages:
+            safe_print(error)
         print()
 
     print("Download statistics:")
@@ -768,9 +1293,22 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "-j",
         "--threads-number",
-        default=1,
+        default=THREADS_NUMBER,
+        type=int,
+        help=f"Number of threads for parallel exploring and downloading. Setting this parameter to a reasonable value can significantly reduce the overall download time (default: {THREADS_NUMBER}).",
+    )
+    parser.add_argument(
+        "-r",
+        "--max-requests",
+        default=MAX_REQUESTS,
         type=int,
-        help="Number of threads for parallel downloading. Setting this parameter to a reasonable value can significantly reduce the overall download time (default: 1).",
+        help=f"Maximal number of HTTP requests being sent to Onedata at once, it does not limit the transfers of file content in progress (default: {MAX_REQUESTS}).",
+    )
+    parser.add_argument(
+        "--rcvbuf",
+        default=None,
+        type=str,
+        help="Size of the socket receive buffer of HTTP connections, in bytes or a number with unit e.g. 4M. Setting it turns off the automatic tuning of the buffer by the system (default: not set).",
     )
     parser.add_argument(
         "-v",
@@ -802,6 +1340,28 @@ def process_parser(parser: argparse.ArgumentParser):
         v_print(V.DEF, "failed on startup; number of threads cannot be lower than one")
         return 4
 
+    global MAX_REQUESTS
+    global REQUESTS_SEMAPHORE
+    MAX_REQUESTS = args.max_requests
+    if MAX_REQUESTS < 1:
+        v_print(V.DEF, "failed on startup; number of concurrent requests cannot be lower than one")
+        return 6
+    REQUESTS_SEMAPHORE = threading.BoundedSemaphore(MAX_REQUESTS)
+
+    # the number of new files waiting for download is bounded according to the number of threads
+    global NEW_FILE_SLOTS
+    NEW_FILE_SLOTS = threading.BoundedSemaphore(THREADS_NUMBER * QUEUED_FILES_PER_THREAD)
+
+    global RECEIVE_BUFFER_SIZE
+    if args.rcvbuf is not None:
+        RECEIVE_BUFFER_SIZE = convert_chunk_size(args.rcvbuf)
+        if RECEIVE_BUFFER_SIZE < 1:
+            v_print(V.DEF, "failed on startup; size of the receive buffer has to be positive")
+            return 7
+
+    # connections used at once: one per explorer, up to SEGMENTS_NUMBER per downloading thread
+    setup_session(pool_size=THREADS_NUMBER * (1 + SEGMENTS_NUMBER))
+
     global ONEZONE
     ONEZONE = clean_onezone(args.onezone)
 
@@ -815,6 +1375,7 @@ def process_parser(parser: argparse.ArgumentParser):
 
 
 def main():
+    start_printer()
     parser = setup_parser()
     result = process_parser(parser)
     if result != 0:
@@ -825,23 +1386,21 @@ def main():
         return 5
 
     try:
-        v_print(V.DEF, "Exploring and creating the directory structure")
-        result = process_node(ONEZONE, FILE_ID, DIRECTORY)
+        # files are downloaded already while the rest of the directory structure is explored
+        v_print(V.DEF, "Exploring and creating the directory structure, downloading files")
+        for thread_number in range(THREADS_NUMBER):
+            threading.Thread(target=thread_worker, args=(thread_number,), daemon=True).start()
+        result = explore(ONEZONE, FILE_ID, DIRECTORY)
+        FILE_QUEUE.join()
         if result:
             print_download_statistics(DIRECTORY, finished=False)
             return result
 
-        v_print(V.DEF, "Downloading files")
-        for thread_number in range(THREADS_NUMBER):
-            result = (
-                threading.Thread(target=thread_worker, args=(thread_number,), daemon=True).start()
-                or result
-            )
-        QP.join()
-        result = 0 if ERROR_QUEUE.qsize() == 0 else 1
+        result = 0 if len(ERROR_QUEUE) == 0 else 1
         print_download_statistics(DIRECTORY)
         return result
     except KeyboardInterrupt as e:
+        SHUTDOWN.set()
         v_print(V.DEF, " prematurely interrupted (" + e.__class__.__name__ + ")")
         print_download_statistics(DIRECTORY, finished=False)
         return 2